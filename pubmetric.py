@@ -1,11 +1,20 @@
-import requests
 import re
-import copy
+import csv
 import click
+import orjson
 import unicodedata
+import threading
+import time
+import calendar
 import pandas as pd
 import datetime as dt
-import xml.etree.ElementTree as et
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from lxml import etree as et
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from urllib3.util.retry import Retry
 from config import TOO_MANY_PAPERS, WITH_INITIAL, NCBI_EMAIL, NCBI_API_KEY
 
 # Contstants, URLs, and search tags
@@ -13,8 +22,25 @@ ATAG = "[Author] "
 LTAG = "[ad] "
 HOST = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 ESEARCH = "{}esearch.fcgi".format(HOST)
-ESUMMARY = "{}esummary.fcgi".format(HOST)
 EFETCH = "{}efetch.fcgi".format(HOST)
+TIMEOUT = 30  # seconds to wait on the NCBI servers before giving up
+MAX_WORKERS = 8  # trainees searched concurrently
+REQUESTS_PER_SECOND = 9  # NCBI allows 10/second with an API key
+BATCH_SIZE = 200  # PMIDs per EFetch request
+ROWS_PER_BATCH = 50  # input rows searched and written out together
+CHUNK_SIZE = 64 * 1024  # bytes of EFETCH XML handed to the parser at a time
+
+# Month numbers keyed by their three-letter abbreviation, for PubMed dates
+MONTHS = {abbr: number for number, abbr in enumerate(calendar.month_abbr)
+          if abbr}
+
+# libxml2 options for the EFETCH XML: skip building the xml:id lookup table,
+# and don't bail on the very long text nodes PubMed occasionally returns.
+# Whitespace-only text is kept, since in titles it separates inline markup
+XML_PARSER_OPTIONS = {
+    'collect_ids': False,
+    'huge_tree': True,
+}
 
 DEFAULT_FETCH_PARAMS = {
     'email': NCBI_EMAIL,
@@ -23,16 +49,38 @@ DEFAULT_FETCH_PARAMS = {
     'retmode': 'json',
 }
 
-EMPTY_TRAINEE_STATS = {
-    # empty dict to hold the information about each trainee
-    'research_papers': 0,  # Placeholder to count Research Papers (not reviews)
-    'first_author_research_papers': 0,
-    'first_author_journals': [],  # empty list for journal titles
-    'reviews': 0,
-    'first_author_reviews': 0,
+
+def empty_trainee_stats():
+    """Return a fresh empty dict to hold the information about a trainee"""
+    return {
+        'research_papers': 0,  # count of Research Papers (not reviews)
+        'first_author_research_papers': 0,
+        'first_author_journals': [],  # empty list for journal titles
+        'reviews': 0,
+        'first_author_reviews': 0,
     }
 
 
+# Columns of the trainee stats output, after the input CSV's own columns
+TRAINEE_STATS_FIELDS = list(empty_trainee_stats()) + [
+    'paper_count', 'pmids', 'error']
+
+# Translation table that replaces the accented Latin-1 and Latin Extended-A
+# characters that turn up in most names with their unaccented ASCII letters,
+# the same result as NFD normalizing them and dropping what isn't ASCII
+_STRIP_ACCENTS = str.maketrans({
+    chr(c): unicodedata.normalize('NFD', chr(c)).encode('ascii', 'ignore')
+    .decode('ascii') for c in range(0x80, 0x180)})
+
+# Translation table that deletes every non-alphanumeric ASCII character.
+# Names are run through strip_accents first, so ASCII is all that remains
+_STRIP_NON_ALNUM = str.maketrans(
+    '', '', ''.join(chr(c) for c in range(128) if not chr(c).isalnum()))
+
+# Loose sanity check on the email address in config.py
+_EMAIL_RE = re.compile(r"[^@]+@[^@]+\.[^@]+")
+
+
 def format_name(last, first, with_initial=True):
     """Standardize name format, and optionally, use the first initial
 
@@ -49,6 +97,7 @@ def format_name(last, first, with_initial=True):
         return last.strip()
 
 
+@lru_cache(maxsize=4096)
 def strip_accents(text):
     """Strip accents from input String. This makes comparing user inupt
     (which often doesn't contain proper accent marks) with the names
@@ -66,12 +115,16 @@ def strip_accents(text):
         text = unicode(text, 'utf-8')
     except (TypeError, NameError):  # unicode is a default on python 3
         pass
-    text = unicodedata.normalize('NFD', text)
-    text = text.encode('ascii', 'ignore')
-    text = text.decode("utf-8")
+    text = text.translate(_STRIP_ACCENTS)
+    # Only characters beyond the table need the full Unicode normalization
+    if not text.isascii():
+        text = unicodedata.normalize('NFD', text)
+        text = text.encode('ascii', 'ignore')
+        text = text.decode("utf-8")
     return str(text)
 
 
+@lru_cache(maxsize=4096)
 def flatten_name(name):
     """ Given a name, transform it to decode accented characters and remove
     non-letters so that the spreadsheet can be compared with the Pubmed result
@@ -85,9 +138,7 @@ def flatten_name(name):
     >>> flatten_name('le Carré')
     'lecarre'
     """
-    name = strip_accents(name.strip().lower())
-    name = re.sub('[^0-9a-zA-Z]', '', name)
-    return name
+    return strip_accents(name).strip().lower().translate(_STRIP_NON_ALNUM)
 
 
 def names_match(name1, name2):
@@ -106,28 +157,320 @@ def names_match(name1, name2):
     return flatten_name(name1) == flatten_name(name2)
 
 
-def extract_identifier(articleIds, id_type):
-    for aid in articleIds:
-        if id_type == aid['idtype']:
-            return aid
+def split_identifiers(articleIds):
+    """Pull the PMC and PubMed identifiers out of a paper's articleids list
+    in a single pass. Either one is None if the paper doesn't have it.
+
+    >>> split_identifiers([{'idtype': 'pubmed', 'value': '1'}])
+    (None, {'idtype': 'pubmed', 'value': '1'})
+    """
+    # Walk backwards so the first identifier of each type wins
+    ids = {aid['idtype']: aid for aid in reversed(articleIds)}
+    return ids.get('pmc'), ids.get('pubmed')
+
+
+class RateLimiter:
+    """Space out calls from any number of threads so that no more than
+    `rate` of them start in a given second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller is allowed to make its request"""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """HTTPAdapter that waits on a RateLimiter before sending each request.
+    The cached session only reaches its adapter on a cache miss, so
+    responses served from the cache aren't throttled
+    """
+
+    def __init__(self, rate_limiter, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.rate_limiter.wait()
+        return super().send(request, **kwargs)
+
+
+# Share one keep-alive connection pool across every NCBI request, stay within
+# the NCBI rate limit, and retry when the servers are throttling us or
+# briefly unavailable. Responses are cached on disk for a day, so re-running
+# an overlapping CSV skips the network
+SESSION = CachedSession(
+    'ncbi_cache',
+    backend='sqlite',
+    expire_after=dt.timedelta(days=1),
+    allowable_methods=('GET',),
+)
+SESSION.mount(HOST, RateLimitedAdapter(
+    RateLimiter(REQUESTS_PER_SECOND),
+    pool_connections=4,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+))
+
+
+def ncbi_get(url, **kwargs):
+    """GET an E-utilities URL through the shared session"""
+    return SESSION.get(url, timeout=TIMEOUT, **kwargs)
+
+
+def batched(items, size):
+    """Split an iterable into consecutive lists of at most `size` items
+
+    >>> list(batched(['1', '2', '3', '4', '5'], 2))
+    [['1', '2'], ['3', '4'], ['5']]
+    """
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+
+def row_values(columns, row):
+    """Map the input CSV's columns to the values in an itertuples() row,
+    leaving missing values blank the way DataFrame.to_csv does
+    """
+    return {column: '' if pd.isna(value) else value
+            for column, value in zip(columns, row[1:])}
+
+
+def fetch_papers_bulk(pmids):
+    """Download the full XML records for a list of PMIDs, BATCH_SIZE papers
+    per request. Returns a dict of Paper objects keyed by PMID
+    """
+    papers = {}
+    for batch in batched(pmids, BATCH_SIZE):
+        params = DEFAULT_FETCH_PARAMS.copy()
+        params['id'] = ','.join(batch)
+        params['retmode'] = 'XML'
+        with ncbi_get(EFETCH, params=params, stream=True) as resp:
+            # Feed the XML to the parser as it arrives, keeping only the
+            # fields we use from each article. iter_content works the same
+            # whether the response came off the network or out of the cache
+            parser = et.XMLPullParser(
+                events=('end',), tag='PubmedArticle', **XML_PARSER_OPTIONS)
+            for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                parser.feed(chunk)
+                for _, article in parser.read_events():
+                    data = extract_paper(article)
+                    authors = extract_authorship(
+                        article.find('MedlineCitation'))
+                    papers[data['uid']] = Paper(data['uid'], data, authors)
+                    clear_element(article)
+            parser.close()
+    return papers
+
+
+def element_text(elem):
+    """Return all the text inside an element, including text in any inline
+    markup like <i> or <sup>, or '' if there's no element
+
+    >>> element_text(et.fromstring('<t>Role of <i>BRCA1</i> in cancer.</t>'))
+    'Role of BRCA1 in cancer.'
+    >>> parser = et.XMLParser(**XML_PARSER_OPTIONS)
+    >>> element_text(et.fromstring(
+    ...     '<t><i>Mycobacterium</i> <i>tuberculosis</i> infection.</t>',
+    ...     parser))
+    'Mycobacterium tuberculosis infection.'
+    """
+    return '' if elem is None else ''.join(elem.itertext())
+
+
+def date_numbers(elem):
+    """Return the year, month and day of a PubMed date element as ints, or
+    None for any part that's missing. Months may be numbers or names, and
+    for a free-text MedlineDate like '2019 Nov-Dec' only the first month
+    counts
+
+    >>> date_numbers(et.fromstring(
+    ...     '<d><MedlineDate>2019 Nov-Dec</MedlineDate></d>'))
+    (2019, 11, None)
+    """
+    medline_date = elem.findtext('MedlineDate')
+    if medline_date:
+        parts = medline_date.split()
+        year = parts[0][:4]
+        month = parts[1][:3] if len(parts) > 1 else None
+        day = None
     else:
-        return None
+        year = elem.findtext('Year')
+        month = elem.findtext('Month')
+        day = elem.findtext('Day')
+
+    if month and not month.isdigit():
+        month = str(MONTHS.get(month[:3].title(), ''))
+    return tuple(int(part) if part and part.isdigit() else None
+                 for part in (year, month, day))
+
+
+def pubmed_date(elem):
+    """Format a PubMed date element the way ESummary does, like '2020 May 3'.
+    A free-text MedlineDate is returned as it is, and a Season follows the year
+
+    >>> pubmed_date(et.fromstring(
+    ...     '<d><Year>2020</Year><Month>05</Month><Day>03</Day></d>'))
+    '2020 May 3'
+    >>> pubmed_date(et.fromstring(
+    ...     '<d><Year>2019</Year><Season>Spring</Season></d>'))
+    '2019 Spring'
+    """
+    if elem is None:
+        return ''
+    medline_date = elem.findtext('MedlineDate')
+    if medline_date:
+        return medline_date
+    year, month, day = date_numbers(elem)
+    parts = [year, calendar.month_abbr[month] if month else None, day,
+             elem.findtext('Season')]
+    return ' '.join(str(part) for part in parts if part)
+
+
+def sort_date(elem):
+    """Format a PubMed date element as a sortable timestamp, the way
+    ESummary's sortpubdate and history dates are written
+
+    >>> sort_date(et.fromstring('<d><Year>2020</Year><Month>May</Month></d>'))
+    '2020/05/01 00:00'
+    """
+    if elem is None:
+        return ''
+    year, month, day = date_numbers(elem)
+    if year is None:
+        return ''
+    hour = int(elem.findtext('Hour', 0))
+    minute = int(elem.findtext('Minute', 0))
+    return f"{year:04}/{month or 1:02}/{day or 1:02} {hour:02}:{minute:02}"
+
+
+def summary_authors(citation):
+    """Given the Medline abstract XML for a paper, build the author list the
+    way ESummary reports it, including collective (group) authors
+    """
+    authors = []
+    for author in citation.iterfind('Article/AuthorList/Author'):
+        collective_name = author.findtext('CollectiveName')
+        if collective_name:
+            name, authtype = collective_name, 'CollectiveName'
+        else:
+            name = ' '.join(filter(None, [author.findtext('LastName'),
+                                          author.findtext('Initials')]))
+            authtype = 'Author'
+        authors.append({'name': name, 'authtype': authtype, 'clusterid': ''})
+    return authors
+
+
+def extract_paper(article):
+    """Given the PubmedArticle XML for a paper, extract the fields exported
+    to the paper content CSV into a plain dict, so the XML element can be
+    discarded afterwards. The keys, order and formats follow the ESummary
+    endpoint's record for a journal article, leaving out the few fields
+    EFETCH doesn't return (see the README)
+    """
+    citation = article.find('MedlineCitation')
+    journal = citation.find('Article/Journal')
+    pubdate = journal.find('JournalIssue/PubDate')
+    authors = summary_authors(citation)
+    pubtypes = citation.iterfind(
+        'Article/PublicationTypeList/PublicationType')
+    articleids = article.iterfind('PubmedData/ArticleIdList/ArticleId')
+    history = article.iterfind('PubmedData/History/PubMedPubDate')
+    elocationids = citation.iterfind('Article/ELocationID')
+    return {
+        'uid': citation.findtext('PMID'),
+        'pubdate': pubmed_date(pubdate),
+        'epubdate': pubmed_date(
+            citation.find("Article/ArticleDate[@DateType='Electronic']")),
+        'source': citation.findtext('MedlineJournalInfo/MedlineTA', ''),
+        'authors': authors,
+        'lastauthor': authors[-1]['name'] if authors else '',
+        'title': element_text(citation.find('Article/ArticleTitle')),
+        'volume': journal.findtext('JournalIssue/Volume', ''),
+        'issue': journal.findtext('JournalIssue/Issue', ''),
+        'pages': citation.findtext('Article/Pagination/MedlinePgn', ''),
+        'lang': [lang.text for lang in citation.iterfind('Article/Language')],
+        'nlmuniqueid': citation.findtext(
+            'MedlineJournalInfo/NlmUniqueID', ''),
+        'issn': journal.findtext("ISSN[@IssnType='Print']", ''),
+        'essn': journal.findtext("ISSN[@IssnType='Electronic']", ''),
+        'pubtype': [pubtype.text for pubtype in pubtypes],
+        'articleids': [{'idtype': aid.get('IdType'), 'value': aid.text}
+                       for aid in articleids],
+        'history': [{'pubstatus': date.get('PubStatus'),
+                     'date': sort_date(date)} for date in history],
+        'attributes': ['Has Abstract']
+        if citation.find('Article/Abstract') is not None else [],
+        'fulljournalname': journal.findtext('Title', ''),
+        'elocationid': ' '.join(f"{eid.get('EIdType')}: {eid.text}"
+                                for eid in elocationids),
+        'doctype': 'citation',
+        'sortpubdate': sort_date(pubdate),
+        'sortfirstauthor': authors[0]['name'] if authors else '',
+        'vernaculartitle': element_text(
+            citation.find('Article/VernacularTitle')),
+    }
+
+
+def extract_authorship(citation):
+    """Given the Medline abstract XML for a paper, extract the author list
+    as plain dicts, so the XML element can be discarded afterwards
+    """
+    paper_authors = []
+
+    # Authors are always direct children of the article's AuthorList, so
+    # there's no need to search the whole citation for them
+    for author in citation.iterfind('Article/AuthorList/Author'):
+        attribs = author.attrib
+        author_dict = {
+            a.tag: a.text.strip() for a in author if a.text}
+        if 'LastName' in author_dict:
+            paper_authors.append(dict(attribs, **author_dict))
+    return paper_authors
+
+
+def clear_element(elem):
+    """Free a fully parsed element, along with any preceding siblings of it
+    and its ancestors, so iterparse doesn't accumulate the whole document
+    """
+    elem.clear()
+    for ancestor in [elem, *elem.iterancestors()]:
+        while ancestor.getprevious() is not None:
+            del ancestor.getparent()[0]
 
 
 class AuthorSearch:
     def __init__(self, row, with_initial=WITH_INITIAL):
         """Initialize this search session with terms"""
         print(row)
-        self.trainee_stats = copy.deepcopy(EMPTY_TRAINEE_STATS)
-        assert self.trainee_stats['first_author_journals'] == []
-        self.abstracts = {}
-        self.summaries = {}
+        self.trainee_stats = empty_trainee_stats()
+        self.papers = {}
+        self.pmids = []
         self.paper_content = []
         self._parse_trainee_mentor(row, with_initial)
 
     def _parse_trainee_mentor(self, row, with_initial):
         """String format the trainee, mentor, and location"""
         self.trainee = format_name(row.LastName, row.FirstName, with_initial)
+        # Flatten once here rather than on every paper that gets scored
+        self.trainee_flat = flatten_name(self.trainee)
+        self.trainee_last_flat = flatten_name(row.LastName)
         mentor = row.ThesisMentor
         try:
             mentor = mentor.split(',')
@@ -148,15 +491,9 @@ class AuthorSearch:
         self.mentor = mentor
         self.location = location
 
-    def _params_with_history(self):
-        params = DEFAULT_FETCH_PARAMS.copy()
-        params['WebEnv'] = self.search_results['webenv']
-        params['query_key'] = self.search_results['querykey']
-        return params
-
     def search(self):
-        """Retrieve the PubMed search results given an author and mentor
-        If no results are found, it returns None"""
+        """Retrieve the PubMed search results given an author and mentor,
+        and record the PMIDs of the papers worth scoring in self.pmids"""
         search_term = self.trainee + ATAG
         if self.mentor:
             search_term += self.mentor + ATAG
@@ -165,47 +502,24 @@ class AuthorSearch:
         print("search term: {}".format(search_term))
 
         params = DEFAULT_FETCH_PARAMS.copy()
-        params['usehistory'] = 'y'  # This caches results on the NCBI server
         params['term'] = search_term
-        resp = requests.get(ESEARCH, params=params)
-        result = resp.json()
+        # Return every PMID we might score, not just the first page of 20
+        params['retmax'] = TOO_MANY_PAPERS
+        resp = ncbi_get(ESEARCH, params=params)
+        # orjson parses the raw bytes directly, skipping the decode to str
+        result = orjson.loads(resp.content)
 
         if result['header']['version'] != '0.3':
             print("""Warning: the ESearch version has changed.
             Results may be incorrect""")
 
         self.search_results = result['esearchresult']
+        self._check_search_results()
         return result
 
-    def fetch_summaries(self):
-        """Use the search results to download a the paper summaries.
-        This method passes the WebEnv and query_key to fetch all of the
-        results at once. Individual papers can be extracted from the response
-        """
-        params = self._params_with_history()
-        resp = requests.get(ESUMMARY, params=params)
-        summaries_json = resp.json()['result']
-        self.pmids = summaries_json['uids']
-        for pmid in self.pmids:
-            self.summaries[pmid] = PaperSummary(pmid, summaries_json[pmid])
-
-    def fetch_abstracts(self):
-        """Use the search results to download a the full XML record.
-        This method passes the WebEnv and query_key to fetch all of the
-        results at once. Individual papers can be extracted from the response
-        """
-        params = self._params_with_history()
-        params['retmode'] = 'XML'
-        resp = requests.get(EFETCH, params=params)
-        # Store an XML Element Tree
-        abstracts_xml = et.fromstring(resp.text)
-        for abstract in abstracts_xml.findall('.//MedlineCitation'):
-            pmid = abstract.find('.//PMID').text
-            self.abstracts[pmid] = PaperAbstract(pmid, abstract)
-
-    def assess_trainee(self):
-        self.search()
-
+    def _check_search_results(self):
+        """Record the search results in the trainee stats, and decide which
+        papers (if any) should be fetched and scored"""
         # How many total papers did they publish?
         self.trainee_stats['paper_count'] = self.search_results['count']
         # add the list of papers to the trainee stats dict
@@ -214,23 +528,36 @@ class AuthorSearch:
         # If no papers were found in the search, stop here
         if int(self.trainee_stats['paper_count']) == 0:
             self.trainee_stats['error'] = 'Search returned zero results'
-            return self.trainee_stats
+            return
 
         # If a large number of papers were found, the search terms weren't
         # specific enough. Don't attempt further processing
         if int(self.trainee_stats['paper_count']) > TOO_MANY_PAPERS:
             self.trainee_stats['error'] = 'Search returned too many results'
-            return self.trainee_stats
+            return
+
+        self.pmids = self.search_results['idlist']
 
-        self.fetch_summaries()
-        self.fetch_abstracts()
+    def fetch_papers(self):
+        """Download the full XML records for this trainee's search results"""
+        self.papers = fetch_papers_bulk(self.pmids)
 
+    def assess_trainee(self):
+        """Search, download and score the papers for this trainee alone"""
+        self.search()
+        self.fetch_papers()
+        return self.score_papers(self.papers)
+
+    def score_papers(self, papers):
+        """Tally the trainee's reviews, research papers and first-author
+        papers. Papers is a dict keyed by PMID, and may hold papers from
+        other searches as well.
+        """
         for pmid in self.pmids:
-            this_summary = self.summaries[pmid]
-            this_abstract = self.abstracts[pmid]
-            first_author = this_summary.is_first_author(self.trainee) or \
-                this_abstract.is_first_author(self.trainee)
-            if this_summary.is_review():  # if this is a review
+            this_paper = papers[pmid]
+            first_author = this_paper.is_first_author(
+                self.trainee, self.trainee_flat, self.trainee_last_flat)
+            if this_paper.is_review():  # if this is a review
                 self.trainee_stats['reviews'] += 1
                 if first_author:
                     self.trainee_stats['first_author_reviews'] += 1
@@ -239,47 +566,20 @@ class AuthorSearch:
                 if first_author:
                     self.trainee_stats['first_author_research_papers'] += 1
                     self.trainee_stats['first_author_journals'].append(
-                        this_summary.journal_title()
+                        this_paper.journal_title()
                     )
 
             # add the details of this paper to the paper_content list
-            self.paper_content.append(this_summary.data)
+            self.paper_content.append(this_paper.data)
 
         return self.trainee_stats
 
 
 class Paper:
-    def __init__(self, pmid, data):
-        """Initialize a Paper object with a PMID, and paper object data"""
-        self.pmid = pmid
-        self.data = data
-
-    def is_first_author(self, author):
-        raise NotImplementedError
-
-
-class PaperSummary(Paper):
-
-    def is_review(self):
-        """Is this a Review article?"""
-        return True if 'Review' in self.data['pubtype'] else False
-
-    def is_first_author(self, author):
-        """Is this a first-author paper?
-        First checks the first name in the authors list of the paper summary.
-        Then, tries to look for co-first authors in the abstract's author_list.
-        """
-        standard_author = flatten_name(author)
-        first_listed_author = self.data['authors'][0]['name'][:len(author)]
-        return flatten_name(first_listed_author) == standard_author
-
-    def journal_title(self):
-        return self.data['source']
-
-
-class PaperAbstract(Paper):
-    """The PaperAbstract class accepts a pmid and author list extracted from
-    the EFETCH endpoint's XLM Element Tree. It looks something like this:
+    """The Paper class accepts a pmid, the ESummary-style record that
+    extract_paper pulls out of the EFETCH endpoint's XML (exported as-is to
+    the paper content CSV), and the detailed author list used for scoring,
+    which looks something like this:
 
     [{'ValidYN': 'Y',
       'LastName': 'Huxlin',
@@ -291,39 +591,100 @@ class PaperAbstract(Paper):
       'ForeName': 'Matthew R',
       'Initials': 'MR',
       'AffiliationInfo': ''}]
-   """
+    """
 
-    def extract_authorship(self):
-        """Given the Medline abstract XML for a paper,
-        extract the author list
-        """
-        paper_authors = []
+    def __init__(self, pmid, data, authors):
+        """Initialize a Paper object with a PMID, paper object data and the
+        paper's author list"""
+        self.pmid = pmid
+        self.data = data
+        self.authors = authors
+
+    def is_review(self):
+        """Is this a Review article?"""
+        return True if 'Review' in self.data['pubtype'] else False
+
+    def journal_title(self):
+        return self.data['source']
 
-        for author in self.data.findall('.//Author'):
-            attribs = author.attrib
-            author_dict = {
-                a.tag: a.text.strip() for a in author if a.text}
-            if 'LastName' in author_dict.keys():
-                paper_authors.append({**attribs, **author_dict})
-        return paper_authors
+    def extract_authorship(self):
+        """Return the author list extracted from the Medline abstract XML"""
+        return self.authors
 
-    def is_first_author(self, author):
+    def is_first_author(self, author, standard_author=None,
+                        standard_last_name=None):
         """Is this a first-author paper?
-        First checks the first name in the authors list of the paper summary.
-        Then, tries to look for co-first authors in the abstract's author_list.
+        First checks the first name in the paper's author list.
+        Then, tries to look for co-first authors in the rest of the list.
+        Pass standard_author and standard_last_name if flatten_name(author)
+        and the flattened surname are already known. Otherwise the surname
+        is taken to be everything before the last space in author.
+
+        >>> paper = Paper('1', {}, [
+        ...     {'LastName': 'Huxlin', 'Initials': 'KR'},
+        ...     {'LastName': 'Cavanaugh', 'Initials': 'MR',
+        ...      'EqualContrib': 'Y'}])
+        >>> paper.is_first_author('Huxlin K')
+        True
+        >>> paper.is_first_author('Cavanaugh M')
+        True
+
+        The first listed author's surname has to match exactly, and their
+        initials only need to start with the author's, so a trainee searched
+        by first initial matches a middle initial too
+
+        >>> paper = Paper('2', {}, [
+        ...     {'LastName': 'Joyce', 'Initials': 'JA'},
+        ...     {'LastName': 'Joyce', 'Initials': 'L'}])
+        >>> paper.is_first_author('Joyce J')
+        True
+        >>> paper.is_first_author('Joyce L')
+        Found more than one matching author name
+        False
+
+        A longer surname that happens to start with the author's name and
+        initial isn't a match
+
+        >>> paper = Paper('3', {}, [
+        ...     {'LastName': 'Kimsey', 'Initials': 'A'},
+        ...     {'LastName': 'Kim', 'Initials': 'S'}])
+        >>> paper.is_first_author('Kim S')
+        False
         """
-        standard_author = flatten_name(author)
+        if standard_author is None:
+            standard_author = flatten_name(author)
+        if standard_last_name is None:
+            standard_last_name = flatten_name(author.strip().rsplit(' ', 1)[0])
         author_list = self.extract_authorship()
-        matching_authors = [author for author in author_list if
-                            flatten_name(author['LastName'])
-                            in standard_author]
 
-        if len(matching_authors) != 1:
-            print(f"Found `{len(matching_authors)}` matching author names ")
+        # Is the first listed author the same surname, with initials that
+        # start with the author's initials (if any)?
+        if author_list:
+            first = author_list[0]
+            initials = standard_author[len(standard_last_name):]
+            first_initials = flatten_name(first.get('Initials', ''))
+            if flatten_name(first['LastName']) == standard_last_name and \
+                    first_initials.startswith(initials):
+                return True
+
+        # Find the one author matching the name. The generator stops
+        # flattening names as soon as a second match shows it's ambiguous
+        matches = (position for position, paper_author
+                   in enumerate(author_list)
+                   if flatten_name(paper_author['LastName'])
+                   in standard_author)
+        match = next(matches, None)
+
+        if match is None:
+            print("Found `0` matching author names ")
             return False
 
-        is_listed_first = author_list[0] == matching_authors[0]
-        is_co_first = 'EqualContrib' in matching_authors[0].keys()
+        if next(matches, None) is not None:
+            print("Found more than one matching author name")
+            return False
+
+        is_listed_first = match == 0
+        is_co_first = 'EqualContrib' in author_list[match]
         return (is_listed_first or is_co_first)
 
 
@@ -337,40 +698,64 @@ def main(filepath):
 
     # Check to ensure the config.py file was set up correctly
     if NCBI_EMAIL == 'abc@123.com' \
-       or not re.match(r"[^@]+@[^@]+\.[^@]+", NCBI_EMAIL):
+       or not _EMAIL_RE.match(NCBI_EMAIL):
         raise ValueError('Please supply a valid email in the config.py file')
 
     if NCBI_API_KEY == 'abc123':
         raise ValueError('You must add your NCBI API key to config.py')
 
-    infile = pd.read_csv(filepath)
+    # Every column is a name or location, so read them all as strings and
+    # skip pandas' type inference
+    infile = pd.read_csv(filepath, dtype=str)
     # Limit the number of rows for testing.
     # TODO: Make this a command line argument
     # infile = infile[:5]
 
-    trainee_stats = []
-    paper_content = []
-
-    # Iterate over names, search pubmed, and store the results
-    for row in infile.itertuples():
-        a = AuthorSearch(row)
-        trainee_stats.append(a.assess_trainee())
-        paper_content.extend(a.paper_content)
-
     timestamp = dt.datetime.strftime(dt.datetime.now(), '%Y-%m-%d_%H:%M')
-
-    # Export the trainee stats
-    stats = pd.DataFrame(trainee_stats)
-    outfile = pd.concat([infile, stats], axis=1)
-    outfile.to_csv(f'{timestamp}_trainee_stats.csv', index=False)
-
-    # Export the full paper content
-    pc = pd.DataFrame(paper_content)
-    pc['pmc'] = pc['articleids'].apply(
-        lambda x: extract_identifier(x, 'pmc'))
-    pc['pubmed'] = pc['articleids'].apply(
-        lambda x: extract_identifier(x, 'pubmed'))
-    pc.to_csv(f'{timestamp}_paper_content.csv', index=False, encoding='utf-8')
+    stats_file = open(f'{timestamp}_trainee_stats.csv', 'w', newline='',
+                      encoding='utf-8')
+    papers_file = open(f'{timestamp}_paper_content.csv', 'w', newline='',
+                       encoding='utf-8')
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+    with stats_file, papers_file, executor:
+        stats_writer = csv.DictWriter(
+            stats_file, list(infile.columns) + TRAINEE_STATS_FIELDS)
+        stats_writer.writeheader()
+        # The paper columns come from the first paper that gets written
+        papers_writer = None
+
+        # Work through the input a batch of rows at a time, writing out each
+        # batch before starting the next, so memory use stays bounded and
+        # the results so far survive a crash
+        for rows in batched(infile.itertuples(), ROWS_PER_BATCH):
+            # Search pubmed for each name concurrently. They're I/O bound
+            searches = [AuthorSearch(row) for row in rows]
+            list(executor.map(AuthorSearch.search, searches))
+
+            # Download every paper found by any search in the batch in a few
+            # bulk requests, rather than one request per trainee
+            pmids = list(dict.fromkeys(
+                pmid for a in searches for pmid in a.pmids))
+            papers = fetch_papers_bulk(pmids)
+
+            # Score each trainee against the papers from their own search
+            for row, a in zip(rows, searches):
+                trainee_stats = a.score_papers(papers)
+                stats_writer.writerow(
+                    {**row_values(infile.columns, row), **trainee_stats})
+
+                for paper in a.paper_content:
+                    pmc, pubmed = split_identifiers(paper['articleids'])
+                    paper = {**paper, 'pmc': pmc, 'pubmed': pubmed}
+                    if papers_writer is None:
+                        papers_writer = csv.DictWriter(
+                            papers_file, list(paper), extrasaction='ignore')
+                        papers_writer.writeheader()
+                    papers_writer.writerow(paper)
+
+            stats_file.flush()
+            papers_file.flush()
 
 
 if __name__ == "__main__":